@@ -7,18 +7,28 @@ Bot Telegram multifunción:
 - Reportes de recuperación de canales (envía al RECOVERY_CHAT_ID y permite respuesta con botones)
 """
 
+import io
 import os
+import re
+import asyncio
+import random
+import time
 import json
 import logging
-import tempfile
 import aiohttp
 import uuid
+import hashlib
+import functools
+import weakref
+from collections import OrderedDict, deque
 from pathlib import Path
-from datetime import datetime
+from typing import Optional
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 from telegram import InputFile, ChatMember, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -27,6 +37,11 @@ from telegram.ext import (
     filters,
 )
 
+try:
+    import orjson  # opcional: JSON más rápido
+except ImportError:
+    orjson = None
+
 # --- Config ---
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -34,11 +49,19 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 HUGGINGFACE_MODEL = os.getenv("HUGGINGFACE_MODEL", "mistralai/mistral-7b-instruct")
 HUGGINGFACE_API_URL_TEMPLATE = "https://api-inference.huggingface.co/models/{}"
+HF_MAX_RETRIES = max(1, int(os.getenv("HF_MAX_RETRIES", "5")))
+HF_MAX_CONCURRENCY = max(1, int(os.getenv("HF_MAX_CONCURRENCY", "4")))
+HF_RATE_PER_MIN = max(1, int(os.getenv("HF_RATE_PER_MIN", "60")))
+TELEGRAM_GROUP_RATE_PER_MIN = int(os.getenv("TELEGRAM_GROUP_RATE_PER_MIN", "20"))  # límite de Telegram por grupo
 
 IMAGE_PROVIDER = os.getenv("IMAGE_PROVIDER", "none")
 IMAGE_API_KEY = os.getenv("IMAGE_API_KEY", "")
 
-STATE_FILE = os.getenv("STATE_FILE", "state.json")
+STATE_FILE = os.getenv("STATE_FILE", "state.json")  # formato antiguo de un solo archivo, solo para migrar
+# por defecto junto a STATE_FILE, para que siga en el mismo volumen persistente
+STATE_DIR = Path(os.getenv("STATE_DIR", str(Path(STATE_FILE).parent / "state")))
+LLM_CACHE_FILE = os.getenv("LLM_CACHE_FILE", "llm_cache.json")
+LLM_CACHE_MAX = int(os.getenv("LLM_CACHE_MAX", "500"))
 
 RECOVERY_CHAT_ID = os.getenv("RECOVERY_CHAT_ID")
 RECOVERY_ADMIN_IDS = os.getenv("RECOVERY_ADMIN_IDS", "")
@@ -49,20 +72,263 @@ if not TELEGRAM_BOT_TOKEN:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- State management (simple file) ---
-DEFAULT_STATE = {"moderated_chats": [], "histories": {}, "reports": []}
+# --- JSON (orjson si está instalado) ---
+_json_loads = orjson.loads if orjson else json.loads
+
+def _json_dumps_bytes(obj, default=None) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, ensure_ascii=False, default=default).encode("utf-8")
+
+# --- State management (shards + journal) ---
+# El estado se divide en tres shards (chats moderados, historiales y reportes),
+# cada uno con su propio snapshot en STATE_DIR. Cada cambio se añade como una
+# línea JSON al journal común y solo los shards modificados se reescriben, cada
+# SNAPSHOT_EVERY cambios o al apagar. Cada delta lleva un número de secuencia y
+# cada shard guarda el último que incluye, así el replay nunca aplica dos veces
+# el mismo cambio.
+STATE_JOURNAL = STATE_DIR / "journal.jsonl"
+STATE_JOURNAL_OLD = STATE_DIR / "journal.jsonl.old"
+SNAPSHOT_EVERY = 100
+HISTORY_MAX_LEN = 10
+
+MODERATED: set[int] = set()
+HISTORIES: dict[str, deque] = {}
+REPORTS: dict[str, dict] = {}
+
+SHARDS = ("moderated", "histories", "reports")
+_OP_SHARD = {
+    "push_history": "histories",
+    "add_moderated_chat": "moderated",
+    "remove_moderated_chat": "moderated",
+    "add_report": "reports",
+    "update_report": "reports",
+}
 
-def load_state():
-    if not Path(STATE_FILE).exists():
-        save_state(DEFAULT_STATE)
-    with open(STATE_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+_journal_fp = None
+_journal_seq = 0
+_shard_seq = dict.fromkeys(SHARDS, 0)
+_dirty: set[str] = set()
+_dirty_counter = 0
+_snapshot_lock = asyncio.Lock()
+_snapshot_tasks = set()
+
+def _shard_path(name: str) -> Path:
+    return STATE_DIR / f"{name}.json"
+
+def _shard_data(name: str):
+    if name == "moderated":
+        return list(MODERATED)
+    if name == "histories":
+        return HISTORIES
+    return list(REPORTS.values())
+
+def _load_shard_data(name: str, data):
+    if name == "moderated":
+        MODERATED.update(data)
+    elif name == "histories":
+        HISTORIES.update((k, deque(v, maxlen=HISTORY_MAX_LEN)) for k, v in data.items())
+    else:
+        REPORTS.update((r["id"], r) for r in data)
+
+def _apply_delta(delta):
+    op = delta.get("op")
+    if op == "push_history":
+        # deque con maxlen descarta el mensaje más antiguo en O(1)
+        max_len = delta.get("max_len", HISTORY_MAX_LEN)
+        HISTORIES.setdefault(str(delta["chat_id"]), deque(maxlen=max_len)).append(delta["entry"])
+    elif op == "add_moderated_chat":
+        MODERATED.add(delta["chat_id"])
+    elif op == "remove_moderated_chat":
+        MODERATED.discard(delta["chat_id"])
+    elif op == "add_report":
+        REPORTS[delta["report"]["id"]] = delta["report"]
+    elif op == "update_report":
+        report = REPORTS.get(delta["id"])
+        if report:
+            report.update(delta["fields"])
+    else:
+        logger.warning("Operación de journal desconocida: %s", op)
 
-def save_state(state):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def _replay_journal(path, legacy=False):
+    """Aplica al estado los deltas de `path` que los shards aún no incluyen.
+
+    Con legacy=True, las líneas sin "seq" (journals anteriores a la numeración)
+    se aplican siempre.
+    """
+    global _journal_seq
+    if not Path(path).exists():
+        return 0
+    count = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                delta = json.loads(line)
+            except ValueError:
+                # línea incompleta (p. ej. caída a mitad de escritura)
+                logger.warning("Ignorando línea corrupta en %s", path)
+                continue
+            shard = _OP_SHARD.get(delta.get("op"))
+            seq = delta.get("seq")
+            if shard is None:
+                continue
+            if seq is None:
+                if not legacy:
+                    continue
+            elif seq <= _shard_seq[shard]:
+                continue
+            _apply_delta(delta)
+            _dirty.add(shard)
+            _journal_seq = max(_journal_seq, seq or 0)
+            count += 1
+    return count
+
+def _close_journal():
+    global _journal_fp
+    if _journal_fp is not None:
+        _journal_fp.close()
+        _journal_fp = None
+
+def _rotate_journal():
+    """Aparta el journal actual a STATE_JOURNAL_OLD; los nuevos cambios van a un journal vacío."""
+    _close_journal()
+    if not STATE_JOURNAL.exists():
+        return
+    if STATE_JOURNAL_OLD.exists():
+        # un snapshot anterior falló: conservamos ambos journals
+        with open(STATE_JOURNAL_OLD, "a", encoding="utf-8") as old, open(STATE_JOURNAL, "r", encoding="utf-8") as cur:
+            old.write(cur.read())
+        os.remove(STATE_JOURNAL)
+    else:
+        os.replace(STATE_JOURNAL, STATE_JOURNAL_OLD)
+
+def _dump_dirty_shards() -> dict:
+    """Serializa los shards modificados: {ruta: bytes}."""
+    files = {}
+    for name in _dirty:
+        # default=list serializa los historiales (deque) como listas
+        files[_shard_path(name)] = _json_dumps_bytes({"journal_seq": _journal_seq, "data": _shard_data(name)}, default=list)
+    _dirty.clear()
+    return files
+
+def _write_snapshot(files: dict):
+    for path, data in files.items():
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    STATE_JOURNAL_OLD.unlink(missing_ok=True)
+
+def _migrate_legacy_state():
+    """Importa el antiguo STATE_FILE único (y su journal, si lo hay) a los shards."""
+    global _journal_seq
+    with open(STATE_FILE, "rb") as f:
+        legacy = _json_loads(f.read())
+    seq = legacy.get("journal_seq", 0)
+    _journal_seq = seq
+    _shard_seq.update(dict.fromkeys(SHARDS, seq))
+    _load_shard_data("moderated", legacy.get("moderated_chats", []))
+    _load_shard_data("histories", legacy.get("histories", {}))
+    _load_shard_data("reports", legacy.get("reports", []))
+    for path in _legacy_journals():
+        _replay_journal(path, legacy=True)
+    _dirty.update(SHARDS)
+
+def _legacy_journals():
+    legacy_journal = Path(STATE_FILE).with_suffix(".journal")
+    return (Path(str(legacy_journal) + ".old"), legacy_journal)
+
+def _mark_legacy_migrated():
+    """Renombra los archivos antiguos a *.migrated para no volver a importarlos nunca."""
+    for path in (Path(STATE_FILE), *_legacy_journals()):
+        if path.exists():
+            os.replace(path, str(path) + ".migrated")
+    logger.info("Estado migrado de %s a %s/", STATE_FILE, STATE_DIR)
 
-STATE = load_state()
+def load_state():
+    global _journal_seq
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    migrated = not any(_shard_path(name).exists() for name in SHARDS) and Path(STATE_FILE).exists()
+    if migrated:
+        _migrate_legacy_state()
+    for name in SHARDS:
+        path = _shard_path(name)
+        if not path.exists():
+            _dirty.add(name)
+            continue
+        with open(path, "rb") as f:
+            shard = _json_loads(f.read())
+        _shard_seq[name] = shard.get("journal_seq", 0)
+        _journal_seq = max(_journal_seq, _shard_seq[name])
+        _load_shard_data(name, shard.get("data", []))
+    _replay_journal(STATE_JOURNAL_OLD)
+    _replay_journal(STATE_JOURNAL)
+    if _dirty:
+        save_state()
+    if migrated:
+        # solo después de escribir los shards
+        _mark_legacy_migrated()
+
+def save_state():
+    """Escribe los shards modificados de forma síncrona y vacía el journal (arranque/apagado)."""
+    global _dirty_counter
+    files = _dump_dirty_shards()
+    _rotate_journal()
+    _write_snapshot(files)
+    _dirty_counter = 0
+
+async def save_state_async():
+    """Snapshot sin bloquear el event loop: se serializa aquí y se escribe en un hilo."""
+    async with _snapshot_lock:
+        # serializar y rotar es síncrono, así ningún delta queda a medias entre ambos
+        names = set(_dirty)
+        files = _dump_dirty_shards()
+        _rotate_journal()
+        try:
+            await asyncio.to_thread(_write_snapshot, files)
+        except Exception:
+            _dirty.update(names)
+            logger.exception("No pude escribir el snapshot de estado")
+
+def _schedule_snapshot():
+    global _dirty_counter
+    _dirty_counter = 0
+    try:
+        task = asyncio.get_running_loop().create_task(save_state_async())
+    except RuntimeError:
+        # sin event loop (p. ej. al arrancar): snapshot síncrono
+        save_state()
+        return
+    _snapshot_tasks.add(task)
+    task.add_done_callback(_snapshot_tasks.discard)
+
+def journal_append(delta):
+    global _journal_fp, _journal_seq, _dirty_counter
+    if _journal_fp is None:
+        _journal_fp = open(STATE_JOURNAL, "a", encoding="utf-8")
+    _journal_seq += 1
+    delta["seq"] = _journal_seq
+    _journal_fp.write(json.dumps(delta, ensure_ascii=False) + "\n")
+    _journal_fp.flush()
+    _dirty_counter += 1
+    if _dirty_counter >= SNAPSHOT_EVERY:
+        _schedule_snapshot()
+
+def update_state(delta):
+    _apply_delta(delta)
+    _dirty.add(_OP_SHARD[delta["op"]])
+    journal_append(delta)
+
+async def close_state():
+    if _snapshot_tasks:
+        await asyncio.gather(*_snapshot_tasks, return_exceptions=True)
+    save_state()
+    _close_journal()
+
+load_state()
 
 # --- Utils ---
 EXT_MAP = {
@@ -74,43 +340,112 @@ EXT_MAP = {
     "txt": ".txt",
 }
 
-BANNED_WORDS = ["palabraprohibida1", "palabraprohibida2"]  # personaliza
+# Normalizadas a minúsculas al arrancar, para que cualquier comparación sea correcta
+BANNED_WORDS = tuple(w.lower() for w in ["palabraprohibida1", "palabraprohibida2"])  # personaliza
+# Una sola expresión compilada: la búsqueda se hace en C y sin copiar el texto en minúsculas
+# (?<!\w)/(?!\w) en lugar de \b, para que entradas como "@spam" o "$$" también coincidan
+BANNED_RE = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, BANNED_WORDS)) + r")(?!\w)", re.IGNORECASE) if BANNED_WORDS else None
 
 def is_chat_moderated(chat_id: int) -> bool:
-    return chat_id in STATE.get("moderated_chats", [])
+    return chat_id in MODERATED
 
 def add_moderated_chat(chat_id: int):
-    arr = STATE.setdefault("moderated_chats", [])
-    if chat_id not in arr:
-        arr.append(chat_id)
-        save_state(STATE)
+    if chat_id not in MODERATED:
+        update_state({"op": "add_moderated_chat", "chat_id": chat_id})
 
 def remove_moderated_chat(chat_id: int):
-    arr = STATE.setdefault("moderated_chats", [])
-    if chat_id in arr:
-        arr.remove(chat_id)
-        save_state(STATE)
-
-def push_history(chat_id: int, role: str, content: str, max_len=10):
-    h = STATE.setdefault("histories", {}).setdefault(str(chat_id), [])
-    h.append({"role": role, "content": content})
-    if len(h) > max_len:
-        STATE["histories"][str(chat_id)] = h[-max_len:]
-    save_state(STATE)
-
-def _admin_ids_set():
-    s = set()
-    for p in (RECOVERY_ADMIN_IDS or "").split(","):
-        p = p.strip()
-        if not p:
-            continue
-        try:
-            s.add(int(p))
-        except ValueError:
-            continue
-    return s
+    if chat_id in MODERATED:
+        update_state({"op": "remove_moderated_chat", "chat_id": chat_id})
+
+def push_history(chat_id: int, role: str, content: str, max_len=HISTORY_MAX_LEN):
+    entry = {"role": role, "content": content}
+    update_state({"op": "push_history", "chat_id": str(chat_id), "entry": entry, "max_len": max_len})
+
+# IDs de admins de recuperación, parseados una sola vez al arrancar
+_ADMIN_IDS: frozenset[int] = frozenset(
+    int(p.strip()) for p in (RECOVERY_ADMIN_IDS or "").split(",") if p.strip().removeprefix("-").isdigit()
+)
+
+class TokenBucket:
+    """Limitador de tasa: hasta `capacity` tokens, rellenados a `rate` tokens por segundo."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 # --- Hugging Face (Mistral) helpers ---
+HF_HEADERS = {
+    "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
+    "Accept": "application/json",
+}
+
+# Sesión HTTP compartida: reutiliza conexiones (keep-alive) entre llamadas
+_HF_SESSION: Optional[aiohttp.ClientSession] = None
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _HF_SESSION
+    if _HF_SESSION is None or _HF_SESSION.closed:
+        _HF_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=120),
+        )
+    return _HF_SESSION
+
+async def _close_session():
+    global _HF_SESSION
+    if _HF_SESSION is not None and not _HF_SESSION.closed:
+        await _HF_SESSION.close()
+    _HF_SESSION = None
+
+# Caché LRU de respuestas: (modelo, parámetros, prompt) -> texto generado.
+# El prompt de /chat ya incluye el historial, así que turnos distintos no colisionan.
+def _load_llm_cache():
+    if not Path(LLM_CACHE_FILE).exists():
+        return OrderedDict()
+    try:
+        with open(LLM_CACHE_FILE, "r", encoding="utf-8") as f:
+            return OrderedDict(json.load(f))
+    except (OSError, ValueError):
+        logger.warning("No pude leer %s, se empieza con la caché vacía", LLM_CACHE_FILE)
+        return OrderedDict()
+
+def save_llm_cache():
+    tmp_path = LLM_CACHE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(_LLM_CACHE, f, ensure_ascii=False)
+    os.replace(tmp_path, LLM_CACHE_FILE)
+
+_LLM_CACHE: "OrderedDict[str, str]" = _load_llm_cache()
+
+def _llm_cache_key(prompt: str, max_tokens: int, temperature: float) -> str:
+    return hashlib.sha256(f"{HUGGINGFACE_MODEL}|{max_tokens}|{temperature}|{prompt}".encode("utf-8")).hexdigest()
+
+def _llm_cache_get(key: str) -> Optional[str]:
+    value = _LLM_CACHE.get(key)
+    if value is not None:
+        _LLM_CACHE.move_to_end(key)
+    return value
+
+def _llm_cache_set(key: str, value: str):
+    _LLM_CACHE[key] = value
+    _LLM_CACHE.move_to_end(key)
+    while len(_LLM_CACHE) > LLM_CACHE_MAX:
+        _LLM_CACHE.popitem(last=False)
+
 async def hf_generate_text(prompt: str, max_tokens: int = 512, temperature: float = 0.7):
     """
     Llama a la Inference API de Hugging Face para generar texto con un modelo Mistral.
@@ -118,32 +453,174 @@ async def hf_generate_text(prompt: str, max_tokens: int = 512, temperature: floa
     """
     if not HUGGINGFACE_API_KEY:
         raise RuntimeError("HUGGINGFACE_API_KEY no está configurado en .env")
-    url = HUGGINGFACE_API_URL_TEMPLATE.format(HUGGINGFACE_MODEL)
-    headers = {
-        "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
-        "Accept": "application/json",
-    }
-    payload = {
-        "inputs": prompt,
-        "parameters": {"max_new_tokens": max_tokens, "temperature": temperature},
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=payload, timeout=120) as resp:
-            text = await resp.text()
+    key = _llm_cache_key(prompt, max_tokens, temperature)
+    cached = _llm_cache_get(key)
+    if cached is not None:
+        return cached
+    params = {"max_new_tokens": max_tokens, "temperature": temperature}
+    result, cacheable = await _hf_batched_generate(prompt, params)
+    if cacheable:
+        _llm_cache_set(key, result)
+    return result
+
+# Batching dinámico: las peticiones concurrentes con los mismos parámetros se
+# agrupan (hasta HF_BATCH_MAX o HF_BATCH_WINDOW segundos) en un único POST con
+# una lista de "inputs". Solo agrupa porque los updates se procesan en
+# paralelo (concurrent_updates en main()).
+HF_BATCH_MAX = 8
+HF_BATCH_WINDOW = 0.05
+
+_HF_QUEUE: Optional[asyncio.Queue] = None
+_HF_BATCH_TASK: Optional[asyncio.Task] = None
+_HF_SEND_TASKS = set()
+
+async def _hf_batched_generate(prompt: str, params: dict) -> tuple[str, bool]:
+    global _HF_QUEUE, _HF_BATCH_TASK
+    if _HF_QUEUE is None:
+        _HF_QUEUE = asyncio.Queue()
+    if _HF_BATCH_TASK is None or _HF_BATCH_TASK.done():
+        _HF_BATCH_TASK = asyncio.create_task(_hf_batch_worker())
+    fut = asyncio.get_running_loop().create_future()
+    await _HF_QUEUE.put((prompt, params, fut))
+    return await fut
+
+async def _hf_batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _HF_QUEUE.get()]
+        deadline = loop.time() + HF_BATCH_WINDOW
+        while len(items) < HF_BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
             try:
-                data = json.loads(text)
-            except Exception:
-                raise RuntimeError(f"Hugging Face returned non-JSON response: {text[:400]}")
-            if isinstance(data, dict) and data.get("error"):
-                raise RuntimeError(f"Hugging Face error: {data.get('error')}")
-            if isinstance(data, list) and len(data) > 0 and isinstance(data[0], dict):
-                # formato común: [{"generated_text":"..."}]
-                return data[0].get("generated_text") or ""
-            if isinstance(data, dict):
-                return data.get("generated_text") or data.get("text") or str(data)
-            return str(data)
+                items.append(await asyncio.wait_for(_HF_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        groups = {}
+        for item in items:
+            params = item[1]
+            groups.setdefault((params["max_new_tokens"], params["temperature"]), []).append(item)
+        for group in groups.values():
+            task = asyncio.create_task(_hf_send_batch(group))
+            _HF_SEND_TASKS.add(task)
+            task.add_done_callback(_HF_SEND_TASKS.discard)
+
+def _resolve(fut, result=None, exc=None):
+    if fut.done():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+async def _hf_send_batch(group):
+    try:
+        url = HUGGINGFACE_API_URL_TEMPLATE.format(HUGGINGFACE_MODEL)
+        params = group[0][1]
+        if len(group) > 1:
+            payload = {"inputs": [prompt for prompt, _, _ in group], "parameters": params}
+            try:
+                results = await _hf_request(url, payload, len(group))
+            except HFBatchRejected:
+                # backend que solo acepta un string: se reintenta cada prompt por separado.
+                # Otros errores (429/503 agotados, 401...) fallan el grupo sin multiplicar tráfico.
+                logger.warning("Hugging Face rechazó el batch de %d prompts, se envían uno a uno", len(group), exc_info=True)
+            else:
+                for (_, _, fut), result in zip(group, results):
+                    _resolve(fut, result)
+                return
+        await asyncio.gather(*(_hf_send_single(url, prompt, params, fut) for prompt, params, fut in group))
+    except Exception as e:
+        # que ningún caller quede esperando un future sin resolver
+        for _, _, fut in group:
+            _resolve(fut, exc=e)
+
+async def _hf_send_single(url: str, prompt: str, params: dict, fut):
+    try:
+        results = await _hf_request(url, {"inputs": prompt, "parameters": params})
+    except Exception as e:
+        _resolve(fut, exc=e)
+        return
+    _resolve(fut, results[0])
+
+async def _stop_batcher():
+    global _HF_BATCH_TASK
+    if _HF_BATCH_TASK is not None:
+        _HF_BATCH_TASK.cancel()
+        _HF_BATCH_TASK = None
+    for task in list(_HF_SEND_TASKS):
+        task.cancel()
+    if _HF_SEND_TASKS:
+        await asyncio.gather(*_HF_SEND_TASKS, return_exceptions=True)
+
+def _extract_generated_text(data) -> tuple[str, bool]:
+    """Devuelve (texto, es_generated_text); solo el texto generado no vacío se guarda en caché."""
+    if isinstance(data, list) and len(data) > 0 and isinstance(data[0], dict):
+        # formato común: [{"generated_text":"..."}]
+        text = data[0].get("generated_text") or ""
+        return text, bool(text)
+    if isinstance(data, dict):
+        text = data.get("generated_text") or data.get("text")
+        if text:
+            return text, True
+    return str(data), False
+
+# Limita las llamadas en vuelo y la tasa para no provocar 429 nosotros mismos
+_HF_SEMAPHORE = asyncio.Semaphore(HF_MAX_CONCURRENCY)
+_HF_RATE = TokenBucket(HF_RATE_PER_MIN, HF_RATE_PER_MIN / 60)
+
+def _retry_delay(resp, attempt: int) -> float:
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(30, int(retry_after))
+    return min(30, 2 ** attempt + random.random())
+
+async def _hf_request(url: str, payload: dict, n: int = 1) -> list:
+    """Hace el POST y devuelve una lista con un (texto, es_generated_text) por cada input.
+
+    Reintenta con backoff exponencial cuando HF responde 429 (rate limit) o 503 (modelo cargando).
+    """
+    session = await _get_session()
+    for attempt in range(HF_MAX_RETRIES):
+        await _HF_RATE.acquire()
+        async with _HF_SEMAPHORE:
+            async with session.post(url, headers=HF_HEADERS, json=payload) as resp:
+                if resp.status not in (429, 503) or attempt == HF_MAX_RETRIES - 1:
+                    return await _parse_hf_response(resp, n)
+                delay = _retry_delay(resp, attempt)
+        logger.warning("Hugging Face respondió %s, reintento %d en %.1fs", resp.status, attempt + 1, delay)
+        await asyncio.sleep(delay)
+
+class HFBatchRejected(RuntimeError):
+    """El backend no aceptó una lista de "inputs" (400/422 o nº de resultados distinto)."""
+
+async def _parse_hf_response(resp, n: int) -> list:
+    if n > 1 and resp.status in (400, 422):
+        text = await resp.text()
+        raise HFBatchRejected(f"Hugging Face rejected batched inputs (HTTP {resp.status}): {text[:400]}")
+    try:
+        data = await resp.json(loads=_json_loads)
+    except (aiohttp.ContentTypeError, ValueError):
+        text = await resp.text()
+        raise RuntimeError(f"Hugging Face returned non-JSON response: {text[:400]}")
+    if data is None:
+        raise RuntimeError(f"Hugging Face returned an empty response (HTTP {resp.status})")
+    if isinstance(data, dict) and data.get("error"):
+        raise RuntimeError(f"Hugging Face error: {data.get('error')}")
+    if n == 1:
+        return [_extract_generated_text(data)]
+    if not isinstance(data, list) or len(data) != n:
+        raise HFBatchRejected(f"Hugging Face returned {len(data) if isinstance(data, list) else 1} results for {n} inputs")
+    # en batch cada elemento es [{"generated_text": ...}] o {"generated_text": ...}
+    return [_extract_generated_text(item) for item in data]
 
 # --- Command handlers ---
+def _command_text(update) -> str:
+    """Texto tras el comando, conservando saltos de línea (context.args los pierde)."""
+    parts = (update.message.text or "").split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else ""
+
 async def start(update: "telegram.Update", context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Hola — soy un bot multifunción (Mistral).\n"
@@ -163,17 +640,15 @@ async def help_cmd(update, context):
 
 # /generate_script
 async def generate_script(update, context):
-    text = update.message.text or ""
-    args = text.split(" ", 1)
-    if len(args) < 2 or not args[1].strip():
+    body = _command_text(update)
+    if not body:
         await update.message.reply_text("Uso: /generate_script <lenguaje> | <descripcion breve>\nEj: /generate_script python | Lee un CSV y resume columnas")
         return
-    body = args[1].strip()
-    if "|" in body:
-        lang, prompt = map(str.strip, body.split("|", 1))
+    lang, sep, prompt = body.partition("|")
+    if sep:
+        lang, prompt = lang.strip(), prompt.strip()
     else:
-        lang = "txt"
-        prompt = body
+        lang, prompt = "txt", body
 
     await update.message.reply_text(f"Generando script en {lang} con Mistral...")
     system_prompt = f"Genera un script en {lang} que haga lo siguiente:\n{prompt}\nEntrega solo el código, sin explicaciones adicionales."
@@ -189,24 +664,18 @@ async def generate_script(update, context):
     filename = f"script{ext}"
     try:
         await update.message.reply_text("Aquí está el código generado (también te lo adjunto como archivo):")
-        with tempfile.NamedTemporaryFile("w+", suffix=ext, delete=False, encoding="utf-8") as tmp:
-            tmp.write(code)
-            tmp.flush()
-            tmp_path = tmp.name
-        await context.bot.send_document(chat_id=update.effective_chat.id, document=InputFile(tmp_path, filename=filename))
-        Path(tmp_path).unlink(missing_ok=True)
+        bio = io.BytesIO(code.encode("utf-8"))
+        await context.bot.send_document(chat_id=update.effective_chat.id, document=InputFile(bio, filename=filename))
     except Exception:
         logger.exception("Error enviando archivo")
         await update.message.reply_text("No se pudo adjuntar el archivo, te envío el código en texto:\n\n" + code)
 
 # /image (placeholder)
 async def image_cmd(update, context):
-    text = update.message.text or ""
-    args = text.split(" ", 1)
-    if len(args) < 2 or not args[1].strip():
+    prompt = _command_text(update)
+    if not prompt:
         await update.message.reply_text("Uso: /image <descripcion>")
         return
-    prompt = args[1].strip()
 
     if IMAGE_PROVIDER == "none" or not IMAGE_API_KEY:
         await update.message.reply_text("No hay proveedor de imágenes configurado. Si quieres imágenes, dime qué proveedor usar (openai/replicate/stability) y lo configuro.")
@@ -216,30 +685,43 @@ async def image_cmd(update, context):
     # Integración de proveedor de imágenes debe añadirse aquí según IMAGE_PROVIDER.
 
 # /chat usando Mistral (via HF)
+CHAT_SYSTEM_PROMPT = "Eres un asistente conversacional útil y conciso.\n\n"
+
+# Locks por chat; el WeakValueDictionary los libera cuando nadie los usa
+_CHAT_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _chat_lock(chat_id: str) -> asyncio.Lock:
+    lock = _CHAT_LOCKS.get(chat_id)
+    if lock is None:
+        lock = _CHAT_LOCKS[chat_id] = asyncio.Lock()
+    return lock
+
 async def chat_cmd(update, context):
     chat_id = str(update.effective_chat.id)
-    text = update.message.text or ""
-    args = text.split(" ", 1)
-    if len(args) < 2 or not args[1].strip():
+    user_msg = _command_text(update)
+    if not user_msg:
         await update.message.reply_text("Uso: /chat <mensaje>")
         return
-    user_msg = args[1].strip()
-    push_history(chat_id, "user", user_msg)
-
-    history = STATE.get("histories", {}).get(chat_id, [])
-    accumulated = ""
-    for item in history:
-        prefix = "Usuario: " if item["role"] == "user" else "Asistente: "
-        accumulated += prefix + item["content"] + "\n"
-    prompt = "Eres un asistente conversacional útil y conciso.\n\n" + accumulated + "\nUsuario: " + user_msg + "\nAsistente:"
+    # un turno por chat a la vez: si no, dos /chat seguidos intercalan el historial
+    async with _chat_lock(chat_id):
+        push_history(chat_id, "user", user_msg)
+
+        history = HISTORIES.get(chat_id, ())
+        parts = [CHAT_SYSTEM_PROMPT]
+        parts.extend(
+            ("Usuario: " if item["role"] == "user" else "Asistente: ") + item["content"] + "\n"
+            for item in history
+        )
+        parts.append("\nUsuario: " + user_msg + "\nAsistente:")
+        prompt = "".join(parts)
 
-    try:
-        assistant_msg = await hf_generate_text(prompt, max_tokens=512, temperature=0.6)
-        push_history(chat_id, "assistant", assistant_msg)
-        await update.message.reply_text(assistant_msg)
-    except Exception as e:
-        logger.exception("Error en chat Mistral")
-        await update.message.reply_text(f"Error en la IA: {e}")
+        try:
+            assistant_msg = await hf_generate_text(prompt, max_tokens=512, temperature=0.6)
+            push_history(chat_id, "assistant", assistant_msg)
+            await update.message.reply_text(assistant_msg)
+        except Exception as e:
+            logger.exception("Error en chat Mistral")
+            await update.message.reply_text(f"Error en la IA: {e}")
 
 # Moderation helpers
 async def _is_user_admin(update, context):
@@ -276,18 +758,18 @@ async def message_handler(update, context):
     if not msg or not msg.text:
         return
     chat_id = update.effective_chat.id
-    text = msg.text.lower()
-
-    if is_chat_moderated(chat_id):
-        for w in BANNED_WORDS:
-            if w in text:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=msg.message_id)
-                except Exception:
-                    logger.exception("No pude eliminar el mensaje")
-                return
+
+    if BANNED_RE and is_chat_moderated(chat_id) and BANNED_RE.search(msg.text):
+        try:
+            await context.bot.delete_message(chat_id=chat_id, message_id=msg.message_id)
+        except Exception:
+            logger.exception("No pude eliminar el mensaje")
 
 # --- Recuperación de canales ---
+def _utc_now_iso() -> str:
+    # mismo formato que antes ("...Z"), sin el datetime.utcnow() obsoleto
+    return datetime.now(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
 def _create_report(user, channel_url: str):
     report_id = uuid.uuid4().hex[:8]
     report = {
@@ -295,22 +777,33 @@ def _create_report(user, channel_url: str):
         "user_id": user.id,
         "user_name": user.username or f"{user.first_name} {getattr(user, 'last_name', '')}".strip(),
         "channel_url": channel_url,
-        "created_at": datetime.utcnow().isoformat() + "Z",
+        "created_at": _utc_now_iso(),
         "status": "pending",
         "response_by": None,
         "response_at": None,
     }
-    STATE.setdefault("reports", []).append(report)
-    save_state(STATE)
+    update_state({"op": "add_report", "report": report})
     return report
 
+RECOVERY_APPROVE_TEXT = "Proveer ✅"
+RECOVERY_DENY_TEXT = "No proveer ❌"
+
+@functools.lru_cache(maxsize=128)
+def _recovery_keyboard(report_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(RECOVERY_APPROVE_TEXT, callback_data=f"recovery:{report_id}:approve"),
+                InlineKeyboardButton(RECOVERY_DENY_TEXT, callback_data=f"recovery:{report_id}:deny"),
+            ]
+        ]
+    )
+
 async def report_recovery(update, context):
-    text = update.message.text or ""
-    args = text.split(" ", 1)
-    if len(args) < 2 or not args[1].strip():
+    channel_url = " ".join(context.args)
+    if not channel_url:
         await update.message.reply_text("Uso: /report_recovery <url_del_canal>\nEj: /report_recovery https://t.me/mi_canal")
         return
-    channel_url = args[1].strip()
     report = _create_report(update.effective_user, channel_url)
     await update.message.reply_text(f"Reporte creado (ID: {report['id']}). Tu solicitud será revisada por el equipo de recuperación.")
 
@@ -318,14 +811,7 @@ async def report_recovery(update, context):
         await update.message.reply_text("RECOVERY_CHAT_ID no está configurado. No se puede notificar al equipo.")
         return
     try:
-        keyboard = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton("Proveer ✅", callback_data=f"recovery:{report['id']}:approve"),
-                    InlineKeyboardButton("No proveer ❌", callback_data=f"recovery:{report['id']}:deny"),
-                ]
-            ]
-        )
+        keyboard = _recovery_keyboard(report["id"])
         text_to_admin = (
             f"🔔 Nuevo reporte de recuperación\n"
             f"Report ID: {report['id']}\n"
@@ -350,14 +836,13 @@ async def recovery_callback_handler(update, context):
     action = parts[2]
 
     clicker_id = query.from_user.id
-    admins = _admin_ids_set()
+    admins = _ADMIN_IDS
     if admins and clicker_id not in admins:
         await query.edit_message_text(query.message.text + f"\n\n⚠️ Usuario @{query.from_user.username or query.from_user.id} intentó interactuar pero no está autorizado.")
         await query.answer("No estás autorizado para responder este reporte.", show_alert=True)
         return
 
-    reports = STATE.setdefault("reports", [])
-    report = next((r for r in reports if r["id"] == report_id), None)
+    report = REPORTS.get(report_id)
     if not report:
         await query.answer("Reporte no encontrado.", show_alert=True)
         return
@@ -366,13 +851,15 @@ async def recovery_callback_handler(update, context):
         await query.answer("Este reporte ya fue respondido.", show_alert=True)
         return
 
-    if action == "approve":
-        report["status"] = "provided"
-    else:
-        report["status"] = "denied"
-    report["response_by"] = clicker_id
-    report["response_at"] = datetime.utcnow().isoformat() + "Z"
-    save_state(STATE)
+    update_state({
+        "op": "update_report",
+        "id": report_id,
+        "fields": {
+            "status": "provided" if action == "approve" else "denied",
+            "response_by": clicker_id,
+            "response_at": _utc_now_iso(),
+        },
+    })
 
     responder = query.from_user.username or f"{query.from_user.first_name}"
     try:
@@ -392,14 +879,11 @@ async def recovery_callback_handler(update, context):
         logger.exception("No pude notificar al usuario sobre la respuesta al reporte")
 
 async def recovery_status(update, context):
-    text = update.message.text or ""
-    args = text.split(" ", 1)
-    if len(args) < 2 or not args[1].strip():
+    report_id = " ".join(context.args)
+    if not report_id:
         await update.message.reply_text("Uso: /recovery_status <report_id>\nEj: /recovery_status a1b2c3d4")
         return
-    report_id = args[1].strip()
-    reports = STATE.setdefault("reports", [])
-    report = next((r for r in reports if r["id"] == report_id), None)
+    report = REPORTS.get(report_id)
     if not report:
         await update.message.reply_text("Reporte no encontrado.")
         return
@@ -415,8 +899,46 @@ async def recovery_status(update, context):
     await update.message.reply_text(reply)
 
 # --- Main ---
+# Llamadas que no son envíos: no deben gastar el cupo por grupo (p. ej. borrar
+# mensajes prohibidos no puede esperar detrás de las respuestas).
+RATE_LIMIT_EXEMPT_ENDPOINTS = frozenset({"deleteMessage", "getChatMember"})
+
+class SendRateLimiter(AIORateLimiter):
+    """AIORateLimiter que solo limita los envíos (mensajes, documentos, ediciones)."""
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in RATE_LIMIT_EXEMPT_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+def _build_rate_limiter():
+    try:
+        return SendRateLimiter(group_max_rate=TELEGRAM_GROUP_RATE_PER_MIN, group_time_period=60, max_retries=3)
+    except RuntimeError:
+        # AIORateLimiter necesita aiolimiter (extra python-telegram-bot[rate-limiter])
+        logger.warning("aiolimiter no está instalado: el bot arranca sin limitador de envíos")
+        return None
+
+async def on_shutdown(application):
+    await _stop_batcher()
+    await _close_session()
+    await close_state()
+    save_llm_cache()
+
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Updates en paralelo (permite agrupar llamadas a Hugging Face). El resto de
+    # handlers no hace await entre leer y modificar el estado; /chat, que sí
+    # espera a la IA entre ambos, se serializa por chat con _chat_lock().
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_shutdown(on_shutdown)
+    )
+    rate_limiter = _build_rate_limiter()
+    if rate_limiter is not None:
+        builder = builder.rate_limiter(rate_limiter)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_cmd))